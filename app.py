@@ -1,29 +1,46 @@
 import os
 import sqlite3
 import math
+import bisect
 import secrets
 import re
-import gpxpy
-import srtm
+import shutil
+import tempfile
+import hashlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import bleach
-from flask import Flask, render_template, request, redirect, send_from_directory, flash, make_response
+from bleach.sanitizer import Cleaner
+from flask import Flask, render_template, request, redirect, send_from_directory, flash, make_response, session, g
 from flask_compress import Compress
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from werkzeug.exceptions import RequestEntityTooLarge
-from staticmap import StaticMap, Line
 from urllib.parse import urlparse
-from elevation_utils import process_gpx_for_elevation
+from elevation_utils import (process_gpx_for_elevation, parse_gpx_segments, load_gpx_segments,
+                             save_gpx_segments, decimate_route_points)
+from map_utils import save_route_map
 
 # Constants
 UPLOAD_FOLDER = 'uploads'
 DATABASE_PATH = 'routes.db'
+SECRET_KEY_FILE = '.secret_key'
 MAX_CAFE_DISTANCE_M = 2000
+CAFE_DISTANCE_BLOCK = 1 << 20  # Cafe-to-point distances computed per NumPy block
 EARTH_RADIUS_M = 6371000
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
+GPX_COPY_CHUNK_SIZE = 64 * 1024  # Uploads are copied to disk in chunks of this size
 UNKNOWN_LOCATION_THRESHOLD_M = 10000
-STATIC_MAP_SIZE = (400, 300)
+PAGE_CACHE_SIZE = 256  # Rendered pages kept per worker
 DEBUG = False  # Set to False in production
+SAFE_NAME_RE = re.compile(r'[^a-zA-Z0-9_-]')  # Characters not allowed in upload filenames
+
+# Difficulty thresholds: a measure strictly above a bin edge moves up a category
+DIFFICULTY_DISTANCE_BINS_KM = (30, 70, 100)
+DIFFICULTY_ELEVATION_BINS_M = (300, 1000, 2000)
+DIFFICULTY_LABELS = ("Easy", "Moderate", "Hard", "Very Hard")
 
 # Coordinates
 CAMPUS = (52.3813, -1.5616)      # University of Warwick
@@ -32,44 +49,103 @@ CALPE = (38.6425, 0.0422)        # Calpe, Spain
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE  # 5 MB max upload size
-app.secret_key = secrets.token_hex(32)
-
-# Enable Gzip compression
+def load_or_create_keyfile(path):
+    """Read a secret key from path, creating it with a random key on first use."""
+    # Write the key in full to a temporary file, then link it into place.
+    # The link fails if another process got there first, and either way
+    # path only ever holds a complete key
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+    finally:
+        os.remove(tmp_path)
+    with open(path) as f:
+        key = f.read().strip()
+    if not key:
+        raise RuntimeError(f"Secret key file {path} is empty")
+    return key
+
+# Keep the key stable across restarts and workers so sessions stay valid
+app.secret_key = os.environ.get('SECRET_KEY') or load_or_create_keyfile(SECRET_KEY_FILE)
+# Let a front-end server that supports X-Sendfile stream uploaded files
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
+class CompressedPageCache:
+    """Flask-Compress cache backend holding compressed copies of pages
+        served by cached_page(), so each version is compressed once."""
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._items.get(key)
+
+    def set(self, key, value):
+        if key.endswith(';'):
+            # Response wasn't a cached page, see compressed_page_key()
+            return
+        with self._lock:
+            if len(self._items) >= PAGE_CACHE_SIZE:
+                self._items.clear()
+            self._items[key] = value
+
+def compressed_page_key(request):
+    """Key compressed pages by the ETag cached_page() gave them."""
+    return g.get('page_etag', '')
+
+# Enable compression, reusing the compressed body of unchanged pages
+app.config['COMPRESS_CACHE_BACKEND'] = CompressedPageCache
+app.config['COMPRESS_CACHE_KEY'] = compressed_page_key
 Compress(app)
 
-# Setup rate limiting
+# Setup rate limiting. The default in-memory storage is per process, so
+# gunicorn.conf.py only runs several workers when RATELIMIT_STORAGE_URI
+# (e.g. a redis:// URI) shares the counts between them
 limiter = Limiter(
     key_func=get_remote_address,
     app=app,
-    default_limits=["200 per day", "50 per hour"]
+    default_limits=["200 per day", "50 per hour"],
+    storage_uri=os.environ.get('RATELIMIT_STORAGE_URI', 'memory://')
 )
 
+# Background worker for processing uploaded GPX files
+EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Basic allowed tags and attributes for descriptions
+ALLOWED_TAGS = frozenset(['p', 'br', 'strong', 'em', 'ul', 'ol', 'li'])
+ALLOWED_TAGS_WITH_LINKS = ALLOWED_TAGS | {'a'}
+ALLOWED_ATTRIBUTES_WITH_LINKS = {'a': ['href', 'title']}
+
+_cleaners = threading.local()
+
+def get_cleaner(allow_links):
+    """Get this thread's bleach Cleaner, so its html5lib parser is built once
+        rather than on every bleach.clean() call. Cleaners aren't thread-safe."""
+    cleaners = getattr(_cleaners, 'cleaners', None)
+    if cleaners is None:
+        cleaners = _cleaners.cleaners = {
+            False: Cleaner(tags=ALLOWED_TAGS, attributes={}, strip=True),
+            True: Cleaner(tags=ALLOWED_TAGS_WITH_LINKS, attributes=ALLOWED_ATTRIBUTES_WITH_LINKS, strip=True),
+        }
+    return cleaners[allow_links]
+
+@functools.lru_cache(maxsize=1024)
+def clean_html(text, allow_links):
+    """Clean stripped input; cached since forms re-submit the same values."""
+    return get_cleaner(allow_links).clean(text)
+
 def sanitize_input(text, allow_links=False):
     """Sanitize user input to prevent XSS attacks."""
     if not text:
         return ""
-    
-    # Basic allowed tags for descriptions
-    allowed_tags = ['p', 'br', 'strong', 'em', 'ul', 'ol', 'li']
-    if allow_links:
-        allowed_tags.extend(['a'])
-    
-    # Allowed attributes
-    allowed_attributes = {}
-    if allow_links:
-        allowed_attributes['a'] = ['href', 'title']
-    
-    # Clean the input
-    cleaned = bleach.clean(
-        text.strip(),
-        tags=allowed_tags,
-        attributes=allowed_attributes,
-        strip=True
-    )
-    
-    return cleaned
+    return clean_html(text.strip(), bool(allow_links))
 
 def validate_coordinates(lat, lon):
     """Validate latitude and longitude coordinates."""
@@ -97,12 +173,31 @@ def validate_url(url):
     except:
         return False
 
+_db_local = threading.local()
+
 def get_db_connection():
-    """Get a database connection."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
+    """Get this thread's database connection, opening it on first use.
+        The connection is kept open across requests so SQLite's page cache
+        stays warm. Use it as a context manager to commit or roll back."""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA mmap_size=268435456')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-20000')  # 20 MB page cache
+        _db_local.conn = conn
     return conn
 
+def close_db_connection():
+    """Close this thread's database connection, if one is open."""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _db_local.conn = None
+
 def init_db():
     """Initialize the database with required tables and indexes."""
     with get_db_connection() as conn:
@@ -116,7 +211,8 @@ def init_db():
             elevation_gain REAL,
             start_location TEXT,
             difficulty TEXT,
-            offroad INTEGER DEFAULT 0
+            offroad INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'ready'
         )''')
         conn.execute('''CREATE TABLE IF NOT EXISTS cafes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -127,6 +223,18 @@ def init_db():
             website TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )''')
+
+        # Add columns introduced after the initial schema
+        try:
+            conn.execute("ALTER TABLE routes ADD COLUMN status TEXT DEFAULT 'ready'")
+        except sqlite3.OperationalError:
+            # Column already exists
+            pass
+
+        # Background jobs don't survive a restart, so routes still pending
+        # now will never finish. This runs once before gunicorn forks
+        # (preload_app), while no worker can be processing a route
+        conn.execute("UPDATE routes SET status = 'failed' WHERE status = 'pending'")
         
         # Create indexes for better query performance
         conn.execute('''CREATE INDEX IF NOT EXISTS idx_routes_difficulty ON routes(difficulty)''')
@@ -136,6 +244,44 @@ def init_db():
         conn.execute('''CREATE INDEX IF NOT EXISTS idx_cafes_location ON cafes(latitude, longitude)''')
         conn.execute('''CREATE INDEX IF NOT EXISTS idx_cafes_name ON cafes(name)''')
 
+        # R-tree over cafe locations for bounding box searches, kept in step
+        # with the cafes table by triggers
+        conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS cafes_rtree
+                        USING rtree(id, min_lat, max_lat, min_lon, max_lon)''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS cafes_rtree_insert AFTER INSERT ON cafes
+                        BEGIN
+                            INSERT INTO cafes_rtree VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+                        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS cafes_rtree_update AFTER UPDATE OF latitude, longitude ON cafes
+                        BEGIN
+                            UPDATE cafes_rtree SET min_lat = new.latitude, max_lat = new.latitude,
+                                                   min_lon = new.longitude, max_lon = new.longitude
+                            WHERE id = new.id;
+                        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS cafes_rtree_delete AFTER DELETE ON cafes
+                        BEGIN
+                            DELETE FROM cafes_rtree WHERE id = old.id;
+                        END''')
+        # Index cafes added before the R-tree existed
+        conn.execute('''INSERT INTO cafes_rtree
+                        SELECT id, latitude, latitude, longitude, longitude FROM cafes
+                        WHERE id NOT IN (SELECT id FROM cafes_rtree)''')
+
+        # Version counter bumped on every change to routes or cafes, so
+        # rendered pages can be cached until the data they show changes
+        conn.execute('''CREATE TABLE IF NOT EXISTS data_version (version INTEGER NOT NULL)''')
+        conn.execute('''INSERT INTO data_version (version)
+                        SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM data_version)''')
+        for table in ('routes', 'cafes'):
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                conn.execute(f'''CREATE TRIGGER IF NOT EXISTS bump_version_{table}_{event.lower()}
+                                 AFTER {event} ON {table}
+                                 BEGIN UPDATE data_version SET version = version + 1; END''')
+
+    # gunicorn preloads the app before forking workers, and SQLite
+    # connections must not be shared between processes
+    close_db_connection()
+
 init_db()
 
 def haversine(lat1, lon1, lat2, lon2):
@@ -146,45 +292,125 @@ def haversine(lat1, lon1, lat2, lon2):
     dlambda = math.radians(lon2 - lon1)
     
     a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlambda/2)**2
-    return 2 * EARTH_RADIUS_M * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    # min() guards against rounding pushing a just above 1
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0)))
+
+def prepare_point(lat, lon):
+    """Precompute (phi, cos(phi), lambda) for a fixed point used with haversine_to()."""
+    phi = math.radians(lat)
+    return phi, math.cos(phi), math.radians(lon)
+
+def haversine_a(lat, lon, phi2, cos_phi2, lam2):
+    """Haversine "a" term from (lat, lon) to a point prepared with prepare_point().
+        It grows with distance, so it can be compared directly without the
+        sqrt and asin needed to turn it into meters."""
+    phi1 = math.radians(lat)
+    dphi = phi2 - phi1
+    dlambda = lam2 - math.radians(lon)
+    return math.sin(dphi/2)**2 + math.cos(phi1)*cos_phi2*math.sin(dlambda/2)**2
+
+def haversine_to(lat, lon, phi2, cos_phi2, lam2):
+    """Distance in meters from (lat, lon) to a point prepared with prepare_point()."""
+    a = haversine_a(lat, lon, phi2, cos_phi2, lam2)
+    # min() guards against rounding pushing a just above 1
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0)))
+
+def haversine_np(lats, lons, phi2, cos_phi2, lam2):
+    """Vectorized haversine_to() for NumPy arrays of coordinates (in degrees)."""
+    phi1 = np.radians(lats)
+    dphi = phi2 - phi1
+    dlambda = lam2 - np.radians(lons)
+
+    a = np.sin(dphi/2)**2 + np.cos(phi1)*cos_phi2*np.sin(dlambda/2)**2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+# Precomputed trig for the preset start locations
+CAMPUS_RAD = prepare_point(*CAMPUS)
+LEAMINGTON_RAD = prepare_point(*LEAMINGTON)
+CALPE_RAD = prepare_point(*CALPE)
+# UNKNOWN_LOCATION_THRESHOLD_M as a haversine "a" term
+UNKNOWN_LOCATION_THRESHOLD_A = math.sin(UNKNOWN_LOCATION_THRESHOLD_M / (2 * EARTH_RADIUS_M))**2
+
+def route_search_points(segments):
+    """Get a route's points, in radians with cos(latitude), for the cafe search.
+        Points are thinned with decimate_route_points(), since dense GPS
+        fixes add nothing to a search for cafes within a few kilometers.
+        Returns the (phi, lambda, cos(phi)) arrays."""
+    lats = [lats for lats, _, _ in segments]
+    lons = [lons for _, lons, _ in segments]
+    phi = np.radians(np.concatenate(lats)) if lats else np.empty(0)
+    lam = np.radians(np.concatenate(lons)) if lons else np.empty(0)
+    phi, lam = decimate_route_points(phi, lam)
+    return phi, lam, np.cos(phi)
+
+def load_route_points(gpx_file):
+    """Load a route's points for the cafe search from the parsed GPX cache,
+        parsing the GPX file if there is no up-to-date cache."""
+    return route_search_points(load_gpx_segments(os.path.join(UPLOAD_FOLDER, gpx_file)))
 
 def get_cafes_near_route(gpx_file, max_distance_m=MAX_CAFE_DISTANCE_M):
     """Find cafes within max_distance_m meters of the route."""
     cafes_near_route = []
     
-    # Get all cafes
+    # Get route points
+    try:
+        point_phi, point_lam, point_cos = load_route_points(gpx_file)
+    except Exception as e:
+        print(f"Error parsing GPX file {gpx_file}: {e}")
+        return []
+    if point_phi.size == 0:
+        return []
+    
+    # Only fetch cafes inside the route's bounding box grown by max_distance_m
+    margin_phi = max_distance_m / EARTH_RADIUS_M
+    min_phi = float(point_phi.min()) - margin_phi
+    max_phi = float(point_phi.max()) + margin_phi
+    # cafes_rtree stores 32-bit bounds rounded outwards, so this may return
+    # a few extra cafes but never misses one
+    query = '''SELECT cafes.* FROM cafes JOIN cafes_rtree ON cafes_rtree.id = cafes.id
+               WHERE cafes_rtree.max_lat >= ? AND cafes_rtree.min_lat <= ?'''
+    params = [math.degrees(min_phi), math.degrees(max_phi)]
+    max_abs_phi = max(abs(min_phi), abs(max_phi))
+    if max_abs_phi < math.pi / 2:
+        # Longitude margin widens towards the poles; skip it near the
+        # antimeridian rather than splitting the box
+        margin_lam = margin_phi / math.cos(max_abs_phi)
+        min_lam = float(point_lam.min()) - margin_lam
+        max_lam = float(point_lam.max()) + margin_lam
+        if -math.pi <= min_lam and max_lam <= math.pi:
+            query += ' AND cafes_rtree.max_lon >= ? AND cafes_rtree.min_lon <= ?'
+            params += [math.degrees(min_lam), math.degrees(max_lam)]
+    
     with get_db_connection() as conn:
         c = conn.cursor()
-        c.execute('SELECT * FROM cafes')
+        c.execute(query, params)
         all_cafes = c.fetchall()
     
     if not all_cafes:
         return []
     
-    # Parse GPX to get route points
-    try:
-        with open(os.path.join(UPLOAD_FOLDER, gpx_file), 'r') as f:
-            gpx = gpxpy.parse(f)
-            route_points = []
-            for track in gpx.tracks:
-                for segment in track.segments:
-                    for point in segment.points:
-                        route_points.append((point.latitude, point.longitude))
-    except Exception as e:
-        print(f"Error parsing GPX file {gpx_file}: {e}")
-        return []
+    cafe_phi = np.radians(np.array([cafe['latitude'] for cafe in all_cafes], dtype=np.float64))
+    cafe_lam = np.radians(np.array([cafe['longitude'] for cafe in all_cafes], dtype=np.float64))
+    cafe_cos = np.cos(cafe_phi)
+    
+    # Haversine "a" terms from every cafe to every route point, broadcast in
+    # blocks of cafes to keep the cafes x points matrix to about a million
+    # entries. "a" grows with distance, so only each cafe's minimum needs
+    # converting to meters
+    min_a = np.empty(len(all_cafes))
+    block = max(1, CAFE_DISTANCE_BLOCK // point_phi.size)
+    for start in range(0, len(all_cafes), block):
+        rows = slice(start, start + block)
+        dphi = point_phi[None, :] - cafe_phi[rows, None]
+        dlambda = point_lam[None, :] - cafe_lam[rows, None]
+        a = np.sin(dphi/2)**2 + cafe_cos[rows, None]*point_cos[None, :]*np.sin(dlambda/2)**2
+        min_a[rows] = a.min(axis=1)
     
-    # Check each cafe against route points
-    for cafe in all_cafes:
-        min_distance = float('inf')
-        for lat, lon in route_points:
-            distance = haversine(cafe['latitude'], cafe['longitude'], lat, lon)
-            if distance < min_distance:
-                min_distance = distance
-        
-        if min_distance <= max_distance_m:
+    max_a = math.sin(max_distance_m / (2 * EARTH_RADIUS_M))**2
+    for cafe, cafe_min_a in zip(all_cafes, min_a.tolist()):
+        if cafe_min_a <= max_a:
             cafe_dict = dict(cafe)
-            cafe_dict['distance_to_route'] = min_distance
+            cafe_dict['distance_to_route'] = 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(cafe_min_a, 1.0)))
             cafes_near_route.append(cafe_dict)
     
     # Sort by distance to route
@@ -192,20 +418,22 @@ def get_cafes_near_route(gpx_file, max_distance_m=MAX_CAFE_DISTANCE_M):
     return cafes_near_route
 
 def determine_start_location(first_point):
-    """Determine the start location based on proximity to preset locations."""
+    """Determine the start location from the route's first (lat, lon) point."""
     if not first_point:
         return "Unknown"
     
-    d_campus = haversine(first_point.latitude, first_point.longitude, *CAMPUS)
-    d_leam = haversine(first_point.latitude, first_point.longitude, *LEAMINGTON)
-    d_calpe = haversine(first_point.latitude, first_point.longitude, *CALPE)
-    min_dist = min(d_campus, d_leam, d_calpe)
+    lat, lon = first_point
+    # Only the ordering of the distances matters, so compare "a" terms
+    a_campus = haversine_a(lat, lon, *CAMPUS_RAD)
+    a_leam = haversine_a(lat, lon, *LEAMINGTON_RAD)
+    a_calpe = haversine_a(lat, lon, *CALPE_RAD)
+    min_a = min(a_campus, a_leam, a_calpe)
     
-    if min_dist > UNKNOWN_LOCATION_THRESHOLD_M:
+    if min_a > UNKNOWN_LOCATION_THRESHOLD_A:
         return "Other"
-    elif d_campus == min_dist:
+    elif a_campus == min_a:
         return "Campus"
-    elif d_leam == min_dist:
+    elif a_leam == min_a:
         return "Leamington"
     else:
         return "Calpe"
@@ -213,66 +441,63 @@ def determine_start_location(first_point):
 def calculate_difficulty(distance_km, elevation_gain_m):
     """Calculate difficulty rating based on distance and elevation gain.
         I made these up based on routes I have done around warwick. 
-        I.e. very hard is very hard for warwick, not say for Yorkshire."""
-    if distance_km < 30 and elevation_gain_m < 300:
-        return "Easy"
-    elif 30 <= distance_km <= 70 and 300 <= elevation_gain_m <= 1000:
-        return "Moderate"
-    elif 70 < distance_km <= 100 and 1000 < elevation_gain_m <= 2000:
-        return "Hard"
-    elif distance_km > 100 and elevation_gain_m > 2000:
-        return "Very Hard"
-    else:
-        # Pick the highest matching category
-        if distance_km > 100 or elevation_gain_m > 2000:
-            return "Very Hard"
-        elif distance_km > 70 or elevation_gain_m > 1000:
-            return "Hard"
-        elif distance_km > 30 or elevation_gain_m > 300:
-            return "Moderate"
-        else:
-            return "Easy"
-
-def process_gpx_file(filepath):
-    """Process GPX file and return route statistics with improved elevation calculation."""
-    with open(filepath, 'r') as gpx_file:
-        gpx = gpxpy.parse(gpx_file)
-
-        # Use improved elevation calculation that matches Strava/Komoot better
-        # This includes smoothing and filtering to reduce GPS noise
-        distance, elevation_gain = process_gpx_for_elevation(gpx, method="leaflet_elevation")
-
-        # Get first point for location determination
-        first_point = None
-        for track in gpx.tracks:
-            for segment in track.segments:
-                if segment.points:
-                    first_point = segment.points[0]
-                    break
-            if first_point:
-                break
-
-        return gpx, distance, elevation_gain, first_point
-
-def generate_static_map(gpx, route_id, safe_name):
-    """Generate a static map image from GPX data.
+        I.e. very hard is very hard for warwick, not say for Yorkshire.
+        The rating is the highest category reached by either measure."""
+    score = max(bisect.bisect_left(DIFFICULTY_DISTANCE_BINS_KM, distance_km),
+                bisect.bisect_left(DIFFICULTY_ELEVATION_BINS_M, elevation_gain_m))
+    return DIFFICULTY_LABELS[score]
+
+def process_gpx_file(gpx_file):
+    """Process a GPX file (path or file object) and return route statistics with improved elevation calculation."""
+    segments = parse_gpx_segments(gpx_file)
+
+    # Use improved elevation calculation that matches Strava/Komoot better
+    # This includes smoothing and filtering to reduce GPS noise
+    distance, elevation_gain = process_gpx_for_elevation(segments, method="leaflet_elevation")
+
+    # Get first point for location determination
+    first_point = None
+    for lats, lons, _ in segments:
+        if len(lats):
+            first_point = (float(lats[0]), float(lons[0]))
+            break
+
+    return segments, distance, elevation_gain, first_point
+
+def process_route(route_id, gpx_path, safe_name):
+    """Process an uploaded GPX file and fill in the route's statistics.
+        Runs on the background executor, so errors are recorded on the
+        route's status rather than raised."""
+    try:
+        segments, distance, elevation_gain, first_point = process_gpx_file(gpx_path)
+
+        # Calculate route statistics
+        dist_km = distance / 1000
+        start_location = determine_start_location(first_point)
+        difficulty = calculate_difficulty(dist_km, elevation_gain)
+
+        # Cache the parsed points for the cafe search. The thinned points
+        # it uses are also plenty for drawing the 400x300 static map
+        save_gpx_segments(gpx_path, segments)
+        phi, lam, _ = route_search_points(segments)
+        generate_static_map(np.degrees(phi), np.degrees(lam), route_id, safe_name)
+
+        with get_db_connection() as conn:
+            conn.execute('UPDATE routes SET distance=?, elevation_gain=?, start_location=?, difficulty=?, status=? WHERE id=?',
+                         (dist_km, elevation_gain, start_location, difficulty, 'ready', route_id))
+    except Exception as e:
+        print(f"Processing route {route_id} failed: {e}")
+        with get_db_connection() as conn:
+            conn.execute('UPDATE routes SET status=? WHERE id=?', ('failed', route_id))
+
+def generate_static_map(lats, lons, route_id, safe_name):
+    """Generate a static map image from arrays of route coordinates.
         Loads faster on the index page."""
     try:
-        coords = []
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    coords.append((point.longitude, point.latitude))
-        
-        if coords:
-            m = StaticMap(*STATIC_MAP_SIZE)
-            m.add_line(Line(coords, 'blue', 3))
-            image = m.render()
-            static_img_filename = f"{route_id}-{safe_name}.webp"
-            static_img_path = os.path.join(UPLOAD_FOLDER, static_img_filename)
-            # Convert to WebP and optimize
-            image = image.convert("RGB")
-            image.save(static_img_path, format="WEBP", quality=80, method=6)
+        coords = list(zip(lons.tolist(), lats.tolist()))
+        static_img_filename = f"{route_id}-{safe_name}.webp"
+        static_img_path = os.path.join(UPLOAD_FOLDER, static_img_filename)
+        if save_route_map(coords, static_img_path):
             return static_img_filename
         else:
             return ""
@@ -319,9 +544,65 @@ def add_cafe_if_requested(conn, add_cafe_option, cafe_name, cafe_lat, cafe_lon,
     else:
         return "Route uploaded successfully!"
 
+_page_cache = {}
+_page_cache_version = None
+_page_cache_lock = threading.Lock()
+
+def matching_etag(etag):
+    """Find the request's If-None-Match tag for etag. Flask-Compress sends
+        compressed pages as "<etag>:<encoding>", so gzip clients revalidate
+        with that form rather than the plain tag."""
+    for tag in request.if_none_match.as_set():
+        if tag.partition(':')[0] == etag:
+            return tag
+    return None
+
+def cached_page(key, render):
+    """Serve a page built from the routes and cafes tables.
+        Rendered pages are kept until the data version changes, and the
+        version doubles as an ETag so browsers can revalidate with a 304."""
+    global _page_cache_version
+    if session.get('_flashes'):
+        # Flashed messages are shown once, so render this page fresh
+        return render()
+
+    with get_db_connection() as conn:
+        version = conn.execute('SELECT version FROM data_version').fetchone()[0]
+    etag = hashlib.md5(f'{version}:{key}'.encode()).hexdigest()
+
+    client_etag = matching_etag(etag)
+    if client_etag:
+        response = make_response('', 304)
+        # Echo the validator the client holds, which Compress may have
+        # suffixed, so its cached copy keeps matching
+        response.set_etag(client_etag)
+    else:
+        with _page_cache_lock:
+            if _page_cache_version != version or len(_page_cache) >= PAGE_CACHE_SIZE:
+                _page_cache.clear()
+                _page_cache_version = version
+            html = _page_cache.get(key)
+        if html is None:
+            html = render()
+            if not isinstance(html, str):
+                # Error responses aren't cached
+                return html
+            with _page_cache_lock:
+                if _page_cache_version == version:
+                    _page_cache[key] = html
+        response = make_response(html)
+        g.page_etag = etag
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/route/<int:route_id>')
 def route(route_id):
     """Display a specific route with its details and nearby cafes."""
+    return cached_page(('route', route_id), lambda: render_route(route_id))
+
+def render_route(route_id):
+    """Render the page for a route."""
     with get_db_connection() as conn:
         c = conn.cursor()
         c.execute('SELECT * FROM routes WHERE id = ?', (route_id,))
@@ -337,14 +618,21 @@ def route(route_id):
     # Convert Row objects to dictionaries for JSON serialization
     all_cafes = [dict(row) for row in all_cafes_rows]
     
-    # Get cafes near this route
-    cafes_near_route = get_cafes_near_route(route['gpx_file'])
+    # Get cafes near this route, once the GPX file has been processed
+    cafes_near_route = []
+    if route['status'] == 'ready':
+        cafes_near_route = get_cafes_near_route(route['gpx_file'])
     
     return render_template('route.html', route=route, cafes_near_route=cafes_near_route, all_cafes=all_cafes)
 
 @app.route('/')
 def index():
     """Display the main page with all routes."""
+    # The filter form is prefilled from the query string
+    return cached_page(('index', request.query_string), render_index)
+
+def render_index():
+    """Render the main page."""
     with get_db_connection() as conn:
         c = conn.cursor()
         c.execute("SELECT * FROM routes")
@@ -604,62 +892,54 @@ def add_route():
             return render_template('add_route.html')
 
         # Create safe filename (sanitize filename)
-        safe_name = re.sub(r'[^a-zA-Z0-9_-]', '_', name)[:40]
+        safe_name = SAFE_NAME_RE.sub('_', name)[:40]
 
         try:
-            # Insert a dummy row to get the next id
             with get_db_connection() as conn:
                 c = conn.cursor()
-                c.execute('INSERT INTO routes (name, description, tags, gpx_file, distance, elevation_gain, start_location, difficulty, offroad) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                          (name, description, tags, '', 0, 0, '', '', offroad))
+                # Insert a pending row to get the next id; statistics are
+                # filled in by the background worker
+                c.execute('INSERT INTO routes (name, description, tags, gpx_file, distance, elevation_gain, start_location, difficulty, offroad, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (name, description, tags, '', 0, 0, '', '', offroad, 'pending'))
                 route_id = c.lastrowid
 
-            # Save file
-            unique_filename = f"{route_id}-{safe_name}{ext}"
-            filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
-            file.save(filepath)
+                # Save file
+                unique_filename = f"{route_id}-{safe_name}{ext}"
+                filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
+                with open(filepath, 'wb') as f:
+                    shutil.copyfileobj(file.stream, f, GPX_COPY_CHUNK_SIZE)
 
-            # Process GPX file
-            gpx, distance, elevation_gain, first_point = process_gpx_file(filepath)
-            
-            # Calculate route statistics
-            dist_km = distance / 1000
-            start_location = determine_start_location(first_point)
-            difficulty = calculate_difficulty(dist_km, elevation_gain)
-            
-            # Generate static map
-            static_img_filename = generate_static_map(gpx, route_id, safe_name)
+                c.execute('UPDATE routes SET gpx_file=? WHERE id=?', (unique_filename, route_id))
 
-            # Update the database with route data
-            with get_db_connection() as conn:
-                c = conn.cursor()
-                c.execute('UPDATE routes SET gpx_file=?, distance=?, elevation_gain=?, start_location=?, difficulty=? WHERE id=?',
-                         (unique_filename, dist_km, elevation_gain, start_location, difficulty, route_id))
-                
                 # Add cafe if requested
                 message = add_cafe_if_requested(conn, add_cafe_option, cafe_name, cafe_lat, cafe_lon, cafe_desc, cafe_website)
                 flash(message)
 
         except Exception as e:
-            flash(f"Error processing GPX file: {str(e)}")
+            flash(f"Error saving GPX file: {str(e)}")
             return render_template('add_route.html')
 
-        return redirect('/')
+        # Parse the GPX, calculate statistics and render the static map
+        # without holding up the response
+        EXECUTOR.submit(process_route, route_id, filepath, safe_name)
+
+        return redirect(f'/route/{route_id}')
     
     return render_template('add_route.html')
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """Serve uploaded files with appropriate caching headers."""
-    response = make_response(send_from_directory(UPLOAD_FOLDER, filename))
+    # conditional=True answers If-None-Match/If-Modified-Since with a 304
+    response = make_response(send_from_directory(UPLOAD_FOLDER, filename, conditional=True))
     
     # Set caching headers based on file type
     if filename.endswith(('.webp', '.png', '.jpg', '.jpeg')):
-        # Cache images for 7 days
+        # Cache images for 7 days (they can be regenerated under the same name)
         response.headers['Cache-Control'] = 'public, max-age=604800'
     elif filename.endswith('.gpx'):
-        # Cache GPX files for 1 day
-        response.headers['Cache-Control'] = 'public, max-age=86400'
+        # GPX uploads are never rewritten and their names include the route id
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
     else:
         # Default cache for 1 hour
         response.headers['Cache-Control'] = 'public, max-age=3600'
@@ -686,20 +966,35 @@ def handle_file_too_large(e):
     flash("File is too large (max 5MB).")
     return render_template('add_route.html'), 413
 
+@functools.lru_cache(maxsize=None)
+def render_static_page(template_name):
+    """Render a page with no per-request content once per process.
+        Returns the HTML and its ETag."""
+    html = render_template(template_name)
+    return html, hashlib.md5(html.encode()).hexdigest()
+
+def static_page_response(template_name):
+    """Serve a cached static page, answering conditional requests with 304."""
+    html, etag = render_static_page(template_name)
+    response = make_response(html)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response.make_conditional(request)
+
 @app.route('/privacy-policy')
 def privacy_policy():
     """Display privacy policy page."""
-    return render_template('privacy-policy.html')
+    return static_page_response('privacy-policy.html')
 
 @app.route('/terms-of-service')
 def terms_of_service():
     """Display terms of service page."""
-    return render_template('terms-of-service.html')
+    return static_page_response('terms-of-service.html')
 
 @app.route('/about')
 def about():
     """Display about page."""
-    return render_template('about.html')
+    return static_page_response('about.html')
 
 if __name__ == '__main__':
     app.run(debug=DEBUG)
\ No newline at end of file
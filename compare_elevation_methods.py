@@ -1,30 +1,11 @@
 import os
 import re
-import gpxpy
-import srtm
-from elevation_utils import process_gpx_for_elevation
+from elevation_utils import process_gpx_for_elevation, load_gpx_segments
 
 chosen_method = "moving_average_threshold"
 
-def old_elevation_calculation(gpx):
-    """The original elevation calculation method from your app."""
-    elevation_data = srtm.get_data()
-    elevation_data.add_elevations = True
-    
-    for track in gpx.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                srtm_elev = elevation_data.get_elevation(point.latitude, point.longitude)
-                if srtm_elev is not None:
-                    point.elevation = srtm_elev
-
-    elevation_gain = 0
-    for track in gpx.tracks:
-        for segment in track.segments:
-            uphill, _ = segment.get_uphill_downhill()
-            elevation_gain += uphill
-    
-    return elevation_gain
+STRAVA_GAIN_RE = re.compile(r"(\d+)\s*m")  # e.g. "1234 m" in strava-gains.txt
+ROUTE_ID_RE = re.compile(r"^(\d+)-")  # route id prefix of uploaded GPX filenames
 
 def compare_methods():
     """Compare old vs new elevation calculation methods."""
@@ -52,30 +33,35 @@ def compare_methods():
     if os.path.exists(strava_file):
         with open(strava_file, 'r') as sf:
             for line in sf:
-                m = re.search(r"(\d+)\s*m", line)
+                m = STRAVA_GAIN_RE.search(line)
                 if m:
                     strava_gains.append(int(m.group(1)))
     # If file not found or parsing failed, strava_gains may be empty and we'll show N/A
     
     for gpx_file in sorted(gpx_files):
         filepath = os.path.join(upload_dir, gpx_file)
+
+        # Map GPX filename prefix (e.g. '1-...gpx') to strava list index
+        strava_val = None
+        m = ROUTE_ID_RE.match(gpx_file)
+        if m:
+            idx = int(m.group(1)) - 1
+            if 0 <= idx < len(strava_gains):
+                strava_val = strava_gains[idx]
+
+        # Without a Strava value there is nothing to compare, so skip the parse
+        if strava_val is None:
+            print(f"{gpx_file[:30]:<30} {'N/A':<10}")
+            continue
+
         try:
-            with open(filepath, 'r') as f:
-                gpx = gpxpy.parse(f)
             # Compare Strava vs both methods with tuned params
             ma_params = {'window_size': 3, 'base_threshold': 1.5, 'multiplier': 1.5, 'min_segment_distance': 3.0, 'max_gradient': 0.30}
             dist_params = {'smooth_distance': 25.0, 'threshold': 1.5}
 
-            dist, ma_gain = process_gpx_for_elevation(gpx, 'moving_average_threshold', params=ma_params)
-            _, dist_gain = process_gpx_for_elevation(gpx, 'distance_smooth_threshold', params=dist_params)
-
-            # Map GPX filename prefix (e.g. '1-...gpx') to strava list index
-            strava_val = None
-            m = re.match(r"^(\d+)-", gpx_file)
-            if m:
-                idx = int(m.group(1)) - 1
-                if 0 <= idx < len(strava_gains):
-                    strava_val = strava_gains[idx]
+            segments = load_gpx_segments(filepath)
+            dist, ma_gain = process_gpx_for_elevation(segments, 'moving_average_threshold', params=ma_params)
+            _, dist_gain = process_gpx_for_elevation(segments, 'distance_smooth_threshold', params=dist_params)
 
             chosen_method_result = 0
             if ma_gain / dist * 1000 > 11:
@@ -84,33 +70,24 @@ def compare_methods():
                 chosen_method_result = ma_gain
             
             # Compute difference (method - strava) for both methods
-            diff = None
-            diff_pct = None
-            if strava_val is not None:
-                diff_ma = ma_gain - strava_val
-                diff_pct_ma = (diff_ma / strava_val) * 100 if strava_val != 0 else None
-                diff_dist = dist_gain - strava_val
-                diff_pct_dist = (diff_dist / strava_val) * 100 if strava_val != 0 else None
-                diff_chosen = chosen_method_result - strava_val
-                diff_pct_chosen = (diff_chosen / strava_val) * 100 if strava_val != 0 else None
+            diff_ma = ma_gain - strava_val
+            diff_pct_ma = (diff_ma / strava_val) * 100 if strava_val != 0 else None
+            diff_dist = dist_gain - strava_val
+            diff_pct_dist = (diff_dist / strava_val) * 100 if strava_val != 0 else None
+            diff_chosen = chosen_method_result - strava_val
+            diff_pct_chosen = (diff_chosen / strava_val) * 100 if strava_val != 0 else None
 
             route_name = gpx_file[:30]
-            if strava_val is None:
-                strava_display = 'N/A'
-                ma_display = 'N/A'
-                dist_display = 'N/A'
-            else:
-                strava_display = f"{strava_val:.0f}"
-                ma_display = f"{ma_gain:<6.0f} {diff_ma:+.0f} ({diff_pct_ma:+.1f}%)"
-                dist_display = f"{dist_gain:<6.0f} {diff_dist:+.0f} ({diff_pct_dist:+.1f}%)"
-                chosen_display = f"{chosen_method_result:<6.0f} {diff_chosen:+.0f} ({diff_pct_chosen:+.1f}%)"
+            strava_display = f"{strava_val:.0f}"
+            ma_display = f"{ma_gain:<6.0f} {diff_ma:+.0f} ({diff_pct_ma:+.1f}%)"
+            dist_display = f"{dist_gain:<6.0f} {diff_dist:+.0f} ({diff_pct_dist:+.1f}%)"
+            chosen_display = f"{chosen_method_result:<6.0f} {diff_chosen:+.0f} ({diff_pct_chosen:+.1f}%)"
 
             print(f"{route_name:<30} {strava_display:<10} MA: {ma_display:<24} DW: {dist_display:<24} Chosen: {chosen_display}")
 
-            if strava_val is not None:
-                total_strava += strava_val
-                total_new += dist_gain
-                count += 1
+            total_strava += strava_val
+            total_new += dist_gain
+            count += 1
         
         except Exception as e:
             print(f"{gpx_file:<25} ERROR: {str(e)}")
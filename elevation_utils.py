@@ -1,66 +1,66 @@
 import math
+import os
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+import numpy as np
+import srtm
+
+# Length of one degree of latitude in meters, as used by gpxpy
+ONE_DEGREE_M = 2 * math.pi * 6378137.0 / 360
+
+# Number of HGT tiles kept mapped at once (about 2.8 MB each for SRTM3)
+HGT_CACHE_SIZE = 32
+
+# Spacing of the route points kept by decimate_route_points(); closer points
+# add nothing to the cafe search or the 400x300 static maps
+ROUTE_POINT_SPACING_M = 50
 
 def moving_average_filter(elevations, window_size):
     """
     Apply a moving average filter to elevation data.
     """
     if len(elevations) < window_size:
-        return elevations.copy()
+        return list(elevations)
     
-    smoothed = []
+    n = len(elevations)
     half_window = window_size // 2
     
-    for i in range(len(elevations)):
-        start = max(0, i - half_window)
-        end = min(len(elevations), i + half_window + 1)
-        window_values = elevations[start:end]
-        smoothed.append(sum(window_values) / len(window_values))
+    # Window sums from a prefix sum; windows are truncated at the ends
+    csum = np.concatenate(([0.0], np.cumsum(np.asarray(elevations, dtype=np.float64))))
+    index = np.arange(n)
+    start = np.maximum(0, index - half_window)
+    end = np.minimum(n, index + half_window + 1)
+    smoothed = (csum[end] - csum[start]) / (end - start)
     
-    return smoothed
+    return smoothed.tolist()
 
-def distance_based_smoothing(points, smooth_distance):
+def distance_based_smoothing(lats, lons, elevations, smooth_distance):
     """
     For each point we average elevations of points within +/- smooth_distance
     along the route using cumulative distances and a sliding window. This
     produces behavior similar to the original distance-based smoother but
     runs faster.
     """
-    n = len(points)
-    if n < 2:
-        return [p[2] for p in points]
+    elevations = np.asarray(elevations, dtype=np.float64)
+    if len(elevations) < 2:
+        return elevations.tolist()
 
     # Build cumulative distances along the route
-    cumdist = [0.0] * n
-    for i in range(1, n):
-        cumdist[i] = cumdist[i - 1] + haversine_distance(points[i - 1][0], points[i - 1][1],
-                                                         points[i][0], points[i][1])
-
-    smoothed = [0.0] * n
-    left = 0
-    right = 0
-
-    for i in range(n):
-        min_d = cumdist[i] - smooth_distance
-        max_d = cumdist[i] + smooth_distance
-
-        # advance left to the first index with cumdist[left] >= min_d
-        while left < n and cumdist[left] < min_d:
-            left += 1
-
-        # advance right while next point is within max_d
-        while right + 1 < n and cumdist[right + 1] <= max_d:
-            right += 1
-
-        if left <= right:
-            # simple average across window
-            s = 0.0
-            for j in range(left, right + 1):
-                s += points[j][2]
-            smoothed[i] = s / (right - left + 1)
-        else:
-            smoothed[i] = points[i][2]
-
-    return smoothed
+    cumdist = cumulative_distances(lats, lons)
+
+    # Each window runs from the first point at or after cumdist - smooth_distance
+    # to the last point at or before cumdist + smooth_distance; cumdist is
+    # sorted, so both ends come from a binary search
+    left = np.searchsorted(cumdist, cumdist - smooth_distance, side='left')
+    right = np.searchsorted(cumdist, cumdist + smooth_distance, side='right')
+
+    # simple average across window, from a prefix sum
+    csum = np.concatenate(([0.0], np.cumsum(elevations)))
+    smoothed = (csum[right] - csum[left]) / (right - left)
+
+    return smoothed.tolist()
 
 def haversine_distance(lat1, lon1, lat2, lon2):
     """Calculate the great circle distance between two points on Earth in meters."""
@@ -74,16 +74,332 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     a = (math.sin(delta_lat / 2) ** 2 + 
          math.cos(lat1_rad) * math.cos(lat2_rad) * 
          math.sin(delta_lon / 2) ** 2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    c = 2 * math.asin(math.sqrt(min(1.0, a)))  # min() guards against rounding above 1
     
     return R * c
 
-def calculate_elevation_gain(points, distance, method = "distance_smooth_threshold"):
+def cumulative_distances(lats, lons):
+    """
+    Cumulative great circle distance in meters along arrays of coordinates.
+
+    Vectorized haversine_distance() between consecutive points; the first
+    entry is 0.
+    """
+    R = 6371000  # Earth radius in meters
+
+    lat_rad = np.radians(lats)
+    delta_lat = np.diff(lat_rad)
+    delta_lon = np.diff(np.radians(lons))
+
+    a = (np.sin(delta_lat / 2) ** 2 +
+         np.cos(lat_rad[:-1]) * np.cos(lat_rad[1:]) *
+         np.sin(delta_lon / 2) ** 2)
+    steps = R * 2 * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+    return np.concatenate(([0.0], np.cumsum(steps)))
+
+def decimate_route_points(phi, lam, spacing_m=ROUTE_POINT_SPACING_M):
+    """
+    Keep roughly one point every spacing_m meters along the route, plus the
+    last point. Distances use an equirectangular approximation, which is
+    plenty at GPS point spacing.
+
+    Args:
+        phi: Array of latitudes in radians
+        lam: Array of longitudes in radians
+        spacing_m: Distance along the route between kept points, in meters
+
+    Returns:
+        Tuple of (phi, lam) arrays of the kept points
+    """
+    R = 6371000  # Earth radius in meters
+
+    if phi.size < 3:
+        return phi, lam
+    step_x = np.diff(lam) * np.cos((phi[1:] + phi[:-1]) / 2)
+    step_y = np.diff(phi)
+    along = np.concatenate(([0.0], np.cumsum(np.hypot(step_x, step_y)))) * R
+    # Keep the first point in each spacing_m stretch of the route
+    keep = np.empty(phi.size, dtype=bool)
+    keep[0] = True
+    keep[1:] = np.diff(np.floor(along / spacing_m)) > 0
+    keep[-1] = True
+    return phi[keep], lam[keep]
+
+def track_distance_3d(lats, lons, elevations):
+    """
+    3D length of a track segment in meters.
+
+    Vectorized equivalent of gpxpy's GPXTrackSegment.length_3d(), so totals
+    match: a flat-earth approximation for nearby points, falling back to
+    haversine (ignoring elevation) for distant ones.
+
+    Args:
+        lats: Array of latitudes in degrees
+        lons: Array of longitudes in degrees
+        elevations: Array of elevations in meters, NaN where missing
+
+    Returns:
+        Segment length in meters
+    """
+    if len(lats) < 2:
+        return 0.0
+
+    lat1, lat2 = lats[:-1], lats[1:]
+    dlat = lat1 - lat2
+    dlon = lons[:-1] - lons[1:]
+
+    distance_2d = np.hypot(dlat, dlon * np.cos(np.radians(lat1))) * ONE_DEGREE_M
+    # Missing elevations contribute no vertical component
+    dz = np.nan_to_num(np.diff(elevations))
+    distances = np.hypot(distance_2d, dz)
+
+    far = (np.abs(dlat) > .2) | (np.abs(dlon) > .2)
+    if far.any():
+        lat1_rad = np.radians(lat1[far])
+        lat2_rad = np.radians(lat2[far])
+        a = (np.sin((lat1_rad - lat2_rad) / 2) ** 2 +
+             np.sin(np.radians(dlon[far]) / 2) ** 2 * np.cos(lat1_rad) * np.cos(lat2_rad))
+        distances[far] = 2 * 6378137.0 * np.arcsin(np.sqrt(a))
+
+    return float(distances.sum())
+
+def _local_name(tag):
+    """Strip the XML namespace from an element tag."""
+    return tag.rpartition('}')[2]
+
+def parse_gpx_segments(source):
+    """
+    Stream track points out of a GPX file without building a gpxpy object tree.
+
+    Elements are cleared as soon as they have been read, so memory use stays
+    proportional to the output arrays rather than the XML document.
+
+    Args:
+        source: Path or binary file object containing GPX XML
+
+    Returns:
+        List of (lats, lons, elevations) NumPy arrays, one per track segment,
+        with NaN elevations for points that have none
+    """
+    segments = []
+    lats, lons, elevations = [], [], []
+
+    for _, elem in ET.iterparse(source, events=('end',)):
+        tag = _local_name(elem.tag)
+        if tag == 'trkpt':
+            lats.append(float(elem.get('lat')))
+            lons.append(float(elem.get('lon')))
+            ele = None
+            for child in elem:
+                if _local_name(child.tag) == 'ele':
+                    ele = child.text
+                    break
+            elevations.append(float(ele) if ele and ele.strip() else np.nan)
+            elem.clear()
+        elif tag == 'trkseg':
+            segments.append((np.array(lats, dtype=np.float64),
+                             np.array(lons, dtype=np.float64),
+                             np.array(elevations, dtype=np.float64)))
+            lats, lons, elevations = [], [], []
+            elem.clear()
+
+    return segments
+
+def save_gpx_segments(gpx_path, segments):
+    """
+    Cache parsed track segments next to their GPX file, as <gpx_path>.npz.
+
+    The cache is only an optimization, so a failed write is logged rather
+    than raised.
+
+    Args:
+        gpx_path: Path to the GPX file the segments were parsed from
+        segments: List of (lats, lons, elevations) arrays from parse_gpx_segments()
+    """
+    # Segments are stored concatenated, with the end offset of each one
+    arrays = [np.concatenate(values) if values else np.empty(0)
+              for values in zip(*segments)] or [np.empty(0)] * 3
+    bounds = np.cumsum([len(lats) for lats, _, _ in segments], dtype=np.int64)
+    # Write under a unique temporary name so readers never see a partial
+    # file and concurrent writers don't replace each other's temporary file
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(gpx_path) or '.', suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, lats=arrays[0], lons=arrays[1], elevations=arrays[2], bounds=bounds)
+        os.replace(tmp_path, f'{gpx_path}.npz')
+    except OSError as e:
+        print(f"Could not cache GPX points for {gpx_path}: {e}")
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def load_gpx_segments(gpx_path):
+    """
+    parse_gpx_segments() for a GPX file on disk, using the cache written by
+    save_gpx_segments() while it is at least as new as the GPX file.
+
+    Args:
+        gpx_path: Path to the GPX file
+
+    Returns:
+        List of (lats, lons, elevations) NumPy arrays, one per track segment
+    """
+    cache_path = f'{gpx_path}.npz'
+    try:
+        if os.path.getmtime(cache_path) >= os.path.getmtime(gpx_path):
+            with np.load(cache_path) as data:
+                lats, lons, elevations = data['lats'], data['lons'], data['elevations']
+                bounds = data['bounds'].tolist()
+            starts = [0] + bounds[:-1]
+            return [(lats[start:end], lons[start:end], elevations[start:end])
+                    for start, end in zip(starts, bounds)]
+    except (OSError, KeyError, ValueError):
+        # Missing, outdated or unreadable cache, rebuild it
+        pass
+
+    segments = parse_gpx_segments(gpx_path)
+    save_gpx_segments(gpx_path, segments)
+    return segments
+
+def extract_gpx_points(segments):
+    """
+    Collect points and the total 3D distance from parsed track segments.
+
+    Args:
+        segments: List of (lats, lons, elevations) arrays from parse_gpx_segments()
+
+    Returns:
+        Tuple of (lats, lons, elevations) arrays for the points that have an
+        elevation, and the total 3D distance in meters
+    """
+    point_arrays = ([], [], [])
+    distance = 0.0
+
+    for lats, lons, elevations in segments:
+        distance += track_distance_3d(lats, lons, elevations)
+
+        has_elevation = ~np.isnan(elevations)
+        for arrays, values in zip(point_arrays, (lats, lons, elevations)):
+            arrays.append(values[has_elevation])
+
+    lats, lons, elevations = (np.concatenate(arrays) if arrays else np.empty(0)
+                              for arrays in point_arrays)
+    return lats, lons, elevations, distance
+
+_srtm_data = None
+
+def get_srtm_data():
+    """
+    Return the process-wide SRTM data object.
+
+    Sharing one instance keeps the HGT tiles it has already loaded in memory
+    between calls, instead of re-reading them for every GPX file.
+    """
+    global _srtm_data
+    if _srtm_data is None:
+        _srtm_data = srtm.get_data()
+    return _srtm_data
+
+_hgt_cache = OrderedDict()
+_hgt_cache_lock = threading.Lock()
+
+def _hgt_grid(elevation_data, tile_lat, tile_lon):
+    """
+    Return the elevation grid of the HGT tile with the given south-west corner.
+
+    Grids are memory-mapped from the srtm package's local cache, so a tile is
+    only paged in where it is sampled, and the least recently used tiles are
+    dropped beyond HGT_CACHE_SIZE. Returns None if there is no tile.
+    """
+    key = (tile_lat, tile_lon)
+    with _hgt_cache_lock:
+        grid = _hgt_cache.get(key)
+        if grid is not None:
+            _hgt_cache.move_to_end(key)
+            return grid
+
+    file_name = elevation_data.get_file_name(tile_lat + 0.5, tile_lon + 0.5)
+    if not file_name:
+        return None
+
+    path = os.path.join(elevation_data.file_handler.local_cache_dir, file_name)
+    if not os.path.exists(path):
+        # Downloads (and unzips) the tile into the local cache
+        tile = elevation_data.get_file(tile_lat + 0.5, tile_lon + 0.5)
+        if tile is None:
+            return None
+    if os.path.exists(path):
+        data = np.memmap(path, dtype='>i2', mode='r')
+        # The mapped grid replaces the copy srtm keeps in memory
+        elevation_data.files.pop(file_name, None)
+    else:
+        # Tiles stored zipped can't be mapped; use the loaded copy
+        data = np.frombuffer(tile.data, dtype='>i2')
+    side = math.isqrt(data.size)
+    grid = data.reshape(side, side)
+
+    with _hgt_cache_lock:
+        _hgt_cache[key] = grid
+        while len(_hgt_cache) > HGT_CACHE_SIZE:
+            _hgt_cache.popitem(last=False)
+    return grid
+
+def get_srtm_elevations(elevation_data, lats, lons):
+    """
+    Look up SRTM elevations for arrays of coordinates in one batch.
+
+    Points are grouped by 1x1 degree HGT tile so each tile is fetched once and
+    sampled with a single fancy-indexing operation, instead of one
+    get_elevation() call per point. Uses the same row/column rounding as
+    srtm.GeoElevationFile.get_elevation().
+
+    Args:
+        elevation_data: srtm.GeoElevationData instance
+        lats: Array of latitudes in degrees
+        lons: Array of longitudes in degrees
+
+    Returns:
+        Float array of elevations in meters, NaN where no data is available
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    elevations = np.full(lats.shape, np.nan)
+    if lats.size == 0:
+        return elevations
+
+    tile_keys = np.column_stack((np.floor(lats), np.floor(lons))).astype(np.int64)
+    tiles, inverse = np.unique(tile_keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    for tile_index, (tile_lat, tile_lon) in enumerate(tiles):
+        grid = _hgt_grid(elevation_data, int(tile_lat), int(tile_lon))
+        if grid is None:
+            continue
+
+        idx = np.flatnonzero(inverse == tile_index)
+        side = grid.shape[0]
+        rows = np.floor((tile_lat + 1 - lats[idx]) * (side - 1)).astype(np.intp)
+        cols = np.floor((lons[idx] - tile_lon) * (side - 1)).astype(np.intp)
+        np.clip(rows, 0, side - 1, out=rows)
+        np.clip(cols, 0, side - 1, out=cols)
+
+        values = grid[rows, cols].astype(np.float64)
+        # Same void/out-of-range filtering as the srtm package
+        values[(values > 10000) | (values < -1000)] = np.nan
+        elevations[idx] = values
+
+    return elevations
+
+def calculate_elevation_gain(lats, lons, elevations, distance, method = "distance_smooth_threshold"):
     """
     Calculate elevation gain using improved methods that reduce GPS noise.
     
     Args:
-        points: List of (latitude, longitude, elevation) tuples
+        lats: Array of latitudes in degrees
+        lons: Array of longitudes in degrees
+        elevations: Array of elevations in meters
+        distance: Total route distance in meters
         method: Calculation method to use:
             - "distance_smooth_threshold": Distance-based smoothing + threshold (works well when MAV fails on hilly routes)
             - "moving_average_threshold": Moving average + threshold (generally works well)
@@ -91,16 +407,14 @@ def calculate_elevation_gain(points, distance, method = "distance_smooth_thresho
     Returns:
         Total elevation gain in meters
     """
-    if len(points) < 2:
+    if len(elevations) < 2:
         return 0.0
     
-    elevations = [point[2] for point in points]
-    
     if method == "distance_smooth_threshold":
         # Distance-based smoothing (recommended for cycling routes)
         smooth_distance = 25.0
         threshold = 2.0
-        smoothed_elevations = distance_based_smoothing(points, smooth_distance=smooth_distance)
+        smoothed_elevations = distance_based_smoothing(lats, lons, elevations, smooth_distance=smooth_distance)
         return _calculate_gain_with_threshold(smoothed_elevations, threshold=threshold)
 
     elif method == "moving_average_threshold":
@@ -116,21 +430,17 @@ def calculate_elevation_gain(points, distance, method = "distance_smooth_thresho
         threshold = 1.0
         smoothed_elevations = moving_average_filter(elevations, window_size=window_size)
         total_gain_ma = _calculate_gain_with_threshold(smoothed_elevations, threshold=threshold)
-   
+
+        # The moving average result is good enough for flat routes, so only
+        # run the distance-based smoother for hilly ones
+        if total_gain_ma / distance * 1000 <= 11:
+            return total_gain_ma
+
         # Distance-based smoothing
         smooth_distance = 25.0
         threshold = 2.0
-        smoothed_elevations = distance_based_smoothing(points, smooth_distance=smooth_distance)
-        total_gain_db = _calculate_gain_with_threshold(smoothed_elevations, threshold=threshold)
-
-        best_result = 0
-        if total_gain_ma / distance * 1000 > 11:
-            best_result = total_gain_db
-        else:
-            best_result = total_gain_ma
-
-
-        return best_result
+        smoothed_elevations = distance_based_smoothing(lats, lons, elevations, smooth_distance=smooth_distance)
+        return _calculate_gain_with_threshold(smoothed_elevations, threshold=threshold)
 
     else:
         raise ValueError(f"Unknown method: {method}")
@@ -153,13 +463,8 @@ def calculate_leaflet_elevation_ascent(elevations):
     if len(elevations) < 2:
         return 0.0
     
-    total_ascent = 0.0
-    for i in range(1, len(elevations)):
-        dz = elevations[i] - elevations[i - 1]
-        if dz > 0:
-            total_ascent += dz
-    
-    return total_ascent
+    dz = np.diff(np.asarray(elevations, dtype=np.float64))
+    return float(dz[dz > 0].sum())
 
 def _calculate_gain_with_threshold(elevations, threshold):
     """
@@ -172,8 +477,9 @@ def _calculate_gain_with_threshold(elevations, threshold):
     total_gain = 0.0
     accumulated_change = 0.0
     
-    for i in range(1, len(elevations)):
-        change = elevations[i] - elevations[i-1]
+    # A stateful scan, so it stays a loop; zip avoids re-indexing the list
+    for previous, current in zip(elevations, elevations[1:]):
+        change = current - previous
         accumulated_change += change
         
         # If we've accumulated enough uphill change, count it
@@ -190,12 +496,12 @@ def _calculate_gain_with_threshold(elevations, threshold):
     
     return max(0.0, total_gain)
 
-def process_gpx_for_elevation(gpx, method = "leaflet_elevation"):
+def process_gpx_for_elevation(segments, method = "leaflet_elevation"):
     """
-    Process a GPX object to calculate distance and elevation gain.
+    Process GPX track segments to calculate distance and elevation gain.
     
     Args:
-        gpx: GPX object to process
+        segments: List of (lats, lons, elevations) arrays from parse_gpx_segments()
         method: Calculation method to use:
             - "leaflet_elevation": Uses leaflet-elevation algorithm (default) - sums positive elevation differences on raw GPX data
             - "distance_smooth_threshold": Distance-based smoothing + threshold
@@ -205,19 +511,9 @@ def process_gpx_for_elevation(gpx, method = "leaflet_elevation"):
     Returns:
         Tuple of (distance in meters, elevation_gain in meters)
     """
-    # Extract all points from GPX (use original elevations, not SRTM)
-    all_points = []
-    elevations = []
-    
-    for track in gpx.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                if point.elevation is not None:
-                    all_points.append((point.latitude, point.longitude, point.elevation))
-                    elevations.append(point.elevation)
-    
-    # Calculate distance using gpxpy's built-in method (it's quite good)
-    distance = sum([t.length_3d() for t in gpx.tracks])
+    # Extract all points from GPX (use original elevations, not SRTM) and
+    # calculate distance the same way gpxpy's length_3d() does, in one pass
+    lats, lons, elevations, distance = extract_gpx_points(segments)
     
     # Calculate elevation gain based on selected method
     if method == "leaflet_elevation":
@@ -225,17 +521,13 @@ def process_gpx_for_elevation(gpx, method = "leaflet_elevation"):
         elevation_gain = calculate_leaflet_elevation_ascent(elevations)
     else:
         # Use old threshold-based methods with SRTM data
-        import srtm
-        elevation_data = srtm.get_data()
-        elevation_data.add_elevations = True
-        
-        srtm_points = []
-        for point in all_points:
-            lat, lon = point[0], point[1]
-            srtm_elev = elevation_data.get_elevation(lat, lon)
-            if srtm_elev is not None:
-                srtm_points.append((lat, lon, srtm_elev))
+        elevation_data = get_srtm_data()
         
-        elevation_gain = calculate_elevation_gain(srtm_points, distance, method=method)
+        srtm_elevations = get_srtm_elevations(elevation_data, lats, lons)
+
+        # Keep the points SRTM has data for, as parallel arrays
+        has_srtm = ~np.isnan(srtm_elevations)
+        elevation_gain = calculate_elevation_gain(lats[has_srtm], lons[has_srtm], srtm_elevations[has_srtm],
+                                                  distance, method=method)
 
     return distance, elevation_gain
\ No newline at end of file
@@ -1,66 +1,62 @@
 import os
 import sqlite3
-import gpxpy
-import srtm
-from elevation_utils import process_gpx_for_elevation
+import bisect
+from concurrent.futures import ProcessPoolExecutor
+from elevation_utils import process_gpx_for_elevation, load_gpx_segments
 
 UPLOAD_FOLDER = 'uploads'
 DB_PATH = 'routes.db'
 
+# Difficulty thresholds: a measure strictly above a bin edge moves up a category
+DIFFICULTY_DISTANCE_BINS_KM = (30, 70, 100)
+DIFFICULTY_ELEVATION_BINS_M = (300, 1000, 2000)
+DIFFICULTY_LABELS = ("Easy", "Moderate", "Hard", "Very Hard")
+
 def calculate_difficulty(distance_km, elevation_gain_m):
     """Calculate difficulty rating based on distance and elevation gain.
         I made these up based on routes I have done around warwick. 
-        I.e. very hard is very hard for warwick, not say for Yorkshire."""
-    if distance_km < 30 and elevation_gain_m < 300:
-        return "Easy"
-    elif 30 <= distance_km <= 70 and 300 <= elevation_gain_m <= 1000:
-        return "Moderate"
-    elif 70 < distance_km <= 100 and 1000 < elevation_gain_m <= 2000:
-        return "Hard"
-    elif distance_km > 100 and elevation_gain_m > 2000:
-        return "Very Hard"
-    else:
-        # Pick the highest matching category
-        if distance_km > 100 or elevation_gain_m > 2000:
-            return "Very Hard"
-        elif distance_km > 70 or elevation_gain_m > 1000:
-            return "Hard"
-        elif distance_km > 30 or elevation_gain_m > 300:
-            return "Moderate"
-        else:
-            return "Easy"
+        I.e. very hard is very hard for warwick, not say for Yorkshire.
+        The rating is the highest category reached by either measure."""
+    score = max(bisect.bisect_left(DIFFICULTY_DISTANCE_BINS_KM, distance_km),
+                bisect.bisect_left(DIFFICULTY_ELEVATION_BINS_M, elevation_gain_m))
+    return DIFFICULTY_LABELS[score]
+
+def process_route(route):
+    """Recalculate one (id, gpx_file) route. Runs in a worker process.
+        Returns the UPDATE parameters, or None if the GPX file is missing."""
+    route_id, gpx_file = route
+    gpx_path = os.path.join(UPLOAD_FOLDER, gpx_file)
+    if not os.path.exists(gpx_path):
+        print(f"GPX file not found: {gpx_path}")
+        return None
+
+    segments = load_gpx_segments(gpx_path)
+    distance, elevation_gain = process_gpx_for_elevation(segments)
+    
+    # Calculate difficulty
+    distance_km = distance / 1000
+    difficulty = calculate_difficulty(distance_km, elevation_gain)
+    return distance_km, elevation_gain, difficulty, route_id
 
 def recalculate_elevation_with_srtm():
     conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute('SELECT id, gpx_file FROM routes')
     routes = c.fetchall()
 
-    elevation_data = srtm.get_data()
-    elevation_data.add_elevations = True
-
-    for route in routes:
-        gpx_path = os.path.join(UPLOAD_FOLDER, route['gpx_file'])
-        if not os.path.exists(gpx_path):
-            print(f"GPX file not found: {gpx_path}")
-            continue
+    # Routes are independent, so process them on all cores
+    with ProcessPoolExecutor() as executor:
+        results = [result for result in executor.map(process_route, routes, chunksize=4)
+                   if result is not None]
 
-        with open(gpx_path, 'r') as gpx_file:
-            gpx = gpxpy.parse(gpx_file)
-            distance, elevation_gain = process_gpx_for_elevation(gpx)
-        
-        # Calculate difficulty
-        distance_km = distance / 1000
-        difficulty = calculate_difficulty(distance_km, elevation_gain)
-        
-        # Update the route in the database
-        c.execute(
-            'UPDATE routes SET distance = ?, elevation_gain = ?, difficulty = ? WHERE id = ?',
-            (distance_km, elevation_gain, difficulty, route['id'])
-        )
-        print(f"Updated route {route['id']}: distance={distance_km:.2f} km, elevation_gain={elevation_gain:.1f} m, difficulty={difficulty}")
+    for distance_km, elevation_gain, difficulty, route_id in results:
+        print(f"Updated route {route_id}: distance={distance_km:.2f} km, elevation_gain={elevation_gain:.1f} m, difficulty={difficulty}")
 
+    # Update the routes in the database in one transaction
+    c.executemany(
+        'UPDATE routes SET distance = ?, elevation_gain = ?, difficulty = ? WHERE id = ?',
+        results
+    )
     conn.commit()
     conn.close()
 
@@ -0,0 +1,23 @@
+# Gunicorn settings, loaded automatically from the working directory
+import multiprocessing
+import os
+
+worker_class = 'gthread'
+if os.environ.get('RATELIMIT_STORAGE_URI'):
+    # Rate limits are shared (e.g. through redis), so run several worker
+    # processes, each with a few threads to overlap I/O
+    workers = multiprocessing.cpu_count() * 2 + 1
+    threads = 4
+else:
+    # Flask-Limiter's default memory:// storage is per process, so extra
+    # workers would multiply every rate limit. Scale with threads instead
+    workers = 1
+    threads = multiprocessing.cpu_count() * 4
+
+# Import the app once before forking so init_db() runs once and all
+# workers share the same session key
+preload_app = True
+
+# Keep worker heartbeat files in memory; a slow disk can otherwise stall
+# workers long enough to be killed as unresponsive
+worker_tmp_dir = '/dev/shm'
@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from staticmap import StaticMap, Line
+
+STATIC_MAP_SIZE = (400, 300)
+TILE_CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tile_cache')
+TILE_CACHE_MAX_AGE_S = 30 * 24 * 3600  # Re-download map tiles after 30 days
+
+class CachedStaticMap(StaticMap):
+    """
+    StaticMap that keeps downloaded tiles on disk and reuses one HTTP
+    session, since neighbouring routes mostly need the same tiles.
+
+    The cache is shared by the app and scripts/generate_static_maps.py, so
+    regenerating maps mostly reads tiles from disk instead of the OSM tile
+    servers.
+    """
+    session = requests.Session()
+    draw_tiles = True
+
+    def _draw_base_layer(self, image):
+        if self.draw_tiles:
+            super()._draw_base_layer(image)
+
+    def get(self, url, **kwargs):
+        tile_path = os.path.join(TILE_CACHE_FOLDER, urlparse(url).path.lstrip('/'))
+        try:
+            if time.time() - os.path.getmtime(tile_path) < TILE_CACHE_MAX_AGE_S:
+                with open(tile_path, 'rb') as f:
+                    return 200, f.read()
+        except OSError:
+            # Not cached yet
+            pass
+
+        res = self.session.get(url, **kwargs)
+        if res.status_code == 200:
+            # Write under a temporary name, unique across processes and
+            # threads, so readers never see a partial tile
+            tmp_path = f'{tile_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+                with open(tmp_path, 'wb') as f:
+                    f.write(res.content)
+                os.replace(tmp_path, tile_path)
+            except OSError as e:
+                # The cache is only an optimization; the tile downloaded fine
+                print(f"Could not cache map tile {tile_path}: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return res.status_code, res.content
+
+def save_route_map(coords, img_path, fallback=True):
+    """
+    Draw a route on a map and save it as a WebP image.
+
+    Args:
+        coords: List of (longitude, latitude) pairs
+        img_path: Path to write the image to
+        fallback: Draw the route on a plain background if the map tiles
+            can't be downloaded, instead of raising RuntimeError
+
+    Returns:
+        True if an image was written, False if there were no coordinates
+    """
+    if not coords:
+        return False
+
+    m = CachedStaticMap(*STATIC_MAP_SIZE)
+    m.add_line(Line(coords, 'blue', 3))
+    try:
+        image = m.render()
+    except RuntimeError:
+        if not fallback:
+            raise
+        # Tile server unavailable: draw the route on a plain background
+        # rather than leaving the route without a map
+        print(f"Static map tiles unavailable for {img_path}, drawing route only")
+        m.draw_tiles = False
+        image = m.render()
+
+    # Convert to WebP. method=4 (Pillow's default) encodes about twice
+    # as fast as method=6 with no visible difference at this size
+    # render() already returns RGB; only convert if that ever changes
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.save(img_path, format="WEBP", quality=80, method=4)
+    return True
@@ -1,7 +1,10 @@
+# Run from the repo root, which its relative paths assume, as a module
+# like the other scripts:
+#     python -m scripts.fix_start_location
 import os
 import sqlite3
-import gpxpy
 import math
+import xml.etree.ElementTree as ET
 
 UPLOAD_FOLDER = 'uploads'
 DB_PATH = 'routes.db'
@@ -10,28 +13,52 @@ DB_PATH = 'routes.db'
 CAMPUS = (52.3813, -1.5616)      # University of Warwick
 LEAMINGTON = (52.2922, -1.5354)  # Leamington Spa
 
-def haversine(lat1, lon1, lat2, lon2):
+def prepare_point(lat, lon):
+    """Precompute (phi, cos(phi), lambda) for a fixed point used with haversine_to()."""
+    phi = math.radians(lat)
+    return phi, math.cos(phi), math.radians(lon)
+
+def haversine_to(lat, lon, phi2, cos_phi2, lam2):
+    """Distance in meters from (lat, lon) to a point prepared with prepare_point()."""
     R = 6371000
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlambda/2)**2
-    return 2*R*math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-def determine_start_location(gpx):
-    first_point = None
-    for track in gpx.tracks:
-        for segment in track.segments:
-            if segment.points:
-                first_point = segment.points[0]
-                break
-        if first_point:
-            break
+    phi1 = math.radians(lat)
+    dphi = phi2 - phi1
+    dlambda = lam2 - math.radians(lon)
+    a = math.sin(dphi/2)**2 + math.cos(phi1)*cos_phi2*math.sin(dlambda/2)**2
+    return 2*R*math.asin(math.sqrt(min(1.0, a)))
+
+# Precomputed trig for the start locations
+CAMPUS_RAD = prepare_point(*CAMPUS)
+LEAMINGTON_RAD = prepare_point(*LEAMINGTON)
+
+# Beyond this rough distance from both start locations a route is "Other",
+# leaving a wide margin over the 10 km cutoff for the approximation's error
+ROUGH_FAR_M = 12000
+METERS_PER_DEGREE = 111320
 
+def rough_far(lat, lon, anchor, meters):
+    """Cheap equirectangular check that (lat, lon) is more than meters from anchor."""
+    dlat = (lat - anchor[0]) * METERS_PER_DEGREE
+    dlon = (lon - anchor[1]) * METERS_PER_DEGREE * math.cos(math.radians(lat))
+    return dlat*dlat + dlon*dlon > meters*meters
+
+def first_track_point(gpx_path):
+    """Return the (lat, lon) of the first track point in a GPX file, or None.
+        Only reads the file up to that point instead of parsing all of it."""
+    for _, elem in ET.iterparse(gpx_path, events=('start',)):
+        # Attributes are available on the start event
+        if elem.tag.rpartition('}')[2] == 'trkpt':
+            return float(elem.get('lat')), float(elem.get('lon'))
+    return None
+
+def determine_start_location(first_point):
+    """Determine the start location from the route's first (lat, lon) point."""
     if first_point:
-        d_campus = haversine(first_point.latitude, first_point.longitude, *CAMPUS)
-        d_leam = haversine(first_point.latitude, first_point.longitude, *LEAMINGTON)
+        lat, lon = first_point
+        if rough_far(lat, lon, CAMPUS, ROUGH_FAR_M) and rough_far(lat, lon, LEAMINGTON, ROUGH_FAR_M):
+            return "Other"
+        d_campus = haversine_to(lat, lon, *CAMPUS_RAD)
+        d_leam = haversine_to(lat, lon, *LEAMINGTON_RAD)
         min_dist = min(d_campus, d_leam)
         if min_dist > 10000:
             return "Other"
@@ -64,9 +91,7 @@ def update_start_locations():
             print(f"GPX file not found: {gpx_path}")
             continue
 
-        with open(gpx_path, 'r') as gpx_file:
-            gpx = gpxpy.parse(gpx_file)
-            start_location = determine_start_location(gpx)
+        start_location = determine_start_location(first_track_point(gpx_path))
 
         c.execute('UPDATE routes SET start_location=? WHERE id=?', (start_location, route['id']))
         print(f"Route {route['id']}: start_location set to {start_location}")
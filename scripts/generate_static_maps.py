@@ -1,40 +1,60 @@
+# Run from the repo root as a module, so the app's modules are importable:
+#     python -m scripts.generate_static_maps
 import os
 import sqlite3
-import gpxpy
-from staticmap import StaticMap, Line
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from elevation_utils import decimate_route_points, load_gpx_segments
+from map_utils import save_route_map
 
-UPLOAD_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'uploads'))
-DB_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'routes.db'))
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+UPLOAD_FOLDER = os.path.join(REPO_ROOT, 'uploads')
+DB_PATH = os.path.join(REPO_ROOT, 'routes.db')
+# Tiles come from the OSM tile servers, whose usage policy forbids bulk
+# downloading, so keep the parallelism low
+MAX_WORKERS = 2
 
 def generate_static_map(gpx_path, img_path):
     try:
-        with open(gpx_path, 'r') as f:
-            gpx = gpxpy.parse(f)
-        coords = []
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    coords.append((point.longitude, point.latitude))
-        if coords:
-            m = StaticMap(400, 300)
-            m.add_line(Line(coords, 'blue', 3))
-            image = m.render()
-            # Convert to WebP and optimize
-            image = image.convert("RGB")  # Ensure compatibility with WebP
-            image.save(img_path, format="WEBP", quality=80, method=6)
-            return True
+        # Parsed points come from the same cache as the app's cafe search
+        segments = load_gpx_segments(gpx_path)
+        lats = np.concatenate([lats for lats, _, _ in segments]) if segments else np.empty(0)
+        lons = np.concatenate([lons for _, lons, _ in segments]) if segments else np.empty(0)
+        # Thin the points the same way as maps drawn on upload
+        phi, lam = decimate_route_points(np.radians(lats), np.radians(lons))
+        coords = list(zip(np.degrees(lam).tolist(), np.degrees(phi).tolist()))
+        # Without tiles the map would look up to date and never be retried
+        return save_route_map(coords, img_path, fallback=False)
     except Exception as e:
         print(f"Failed to generate static map for {gpx_path}: {e}")
     return False
 
-for route in os.listdir(UPLOAD_FOLDER):
-    if route.endswith('.gpx'):
-        route_id = route.split('-')[0]
-        route_name = route.replace('.gpx', '')
-        gpx_path = os.path.join(UPLOAD_FOLDER, route)
-        img_path = os.path.join(UPLOAD_FOLDER, f"{route_name}.webp")
-        
-        if generate_static_map(gpx_path, img_path):
-            print(f"Static map generated for {route}")
-        else:
-            print(f"Failed to generate static map for {route}")
\ No newline at end of file
+def generate_static_maps():
+    routes = []
+    gpx_paths = []
+    img_paths = []
+    for route in os.listdir(UPLOAD_FOLDER):
+        if route.endswith('.gpx'):
+            route_name = route.replace('.gpx', '')
+            gpx_path = os.path.join(UPLOAD_FOLDER, route)
+            img_path = os.path.join(UPLOAD_FOLDER, f"{route_name}.webp")
+
+            # Skip maps rendered since the GPX file last changed
+            if os.path.exists(img_path) and os.path.getmtime(img_path) >= os.path.getmtime(gpx_path):
+                print(f"Static map up to date for {route}")
+                continue
+
+            routes.append(route)
+            gpx_paths.append(gpx_path)
+            img_paths.append(img_path)
+
+    # Routes are independent, so render a couple at a time
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for route, generated in zip(routes, executor.map(generate_static_map, gpx_paths, img_paths)):
+            if generated:
+                print(f"Static map generated for {route}")
+            else:
+                print(f"Failed to generate static map for {route}")
+
+if __name__ == '__main__':
+    generate_static_maps()